@@ -1,117 +1,383 @@
 #!/usr/bin/env python
 
-import datetime
+import atexit
+import contextlib
+import io
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
+from collections.abc import Iterator
+from typing import BinaryIO
 
+try:
+    from cleo.io.inputs.argv_input import ArgvInput
+    from cleo.io.outputs.buffered_output import BufferedOutput
+    from poetry.console.application import Application
+except ImportError:
+    Application = None
 
-COMMON_FLAGS = [
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+
+COMMON_FLAGS = (
     '-vvv',
     '--no-cache',
     '--no-ansi',
-]
+)
+
+_ADD_COMMAND = ('poetry', 'add', *COMMON_FLAGS, '--lock')
+_BUILD_COMMAND = ('poetry', 'build', *COMMON_FLAGS, '--format', 'wheel')
+_ENV_REMOVE_COMMAND = ('poetry', 'env', 'remove', *COMMON_FLAGS, '--all')
+_LOCK_COMMAND = ('poetry', 'lock', *COMMON_FLAGS)
+_NEW_COMMAND = ('poetry', 'new', *COMMON_FLAGS)
+_PUBLISH_COMMAND = ('poetry', 'publish', *COMMON_FLAGS, '--repository')
+_UPDATE_COMMAND = ('poetry', 'update', *COMMON_FLAGS, '--lock')
+_VERSION_COMMAND = ('poetry', 'version', *COMMON_FLAGS)
+
+# No separators, so Poetry writes it identically as distribution and package name
+_TEMPLATE_NAME = 'poetrytestertemplate'
+
+GIT = shutil.which('git')
+POETRY = shutil.which('poetry')
+
+logger = logging.getLogger('poetry_tester')
+
+# In-process runs reroute the process-wide root logger, so only one can run at a time, even across threads
+_poetry_lock = threading.Lock()
+
+# Opened libgit2 repositories, keyed by project path
+_repositories = {}
+
+# Set by _setup_logger, the output of subprocesses is copied straight into its file
+_log_handler = None
+_log_queue = None
+
+
+# name:levelname:asctime:message, the prefix is only rebuilt when it changes (at most once a second)
+class _Formatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__(datefmt='%Y-%m-%d %H:%M:%S')
+        self._last_key = None
+        self._last_prefix = ''
+
+    def format(self, record: logging.LogRecord) -> str:
+        key = record.name, record.levelname, int(record.created)
+        if key != self._last_key:
+            self._last_key = key
+            self._last_prefix = f'{record.name}:{record.levelname}:{self.formatTime(record, self.datefmt)}:'
+
+        formatted_record = self._last_prefix + record.getMessage()
+        if record.exc_info:
+            formatted_record += '\n' + self.formatException(record.exc_info)
+        if record.stack_info:
+            formatted_record += '\n' + self.formatStack(record.stack_info)
+        return formatted_record
+
+
+@contextlib.contextmanager
+def _capture_logging(stream: io.StringIO) -> Iterator[None]:
+    # Poetry's own logging.basicConfig is a no-op once the root logger has handlers, so send the records logged on
+    # this thread, by Poetry and the libraries it uses, to the command's output instead of the log file
+    thread_id = threading.get_ident()
+    root_logger = logging.getLogger()
+    level = root_logger.level
+
+    capture_handler = logging.StreamHandler(stream)
+    capture_handler.setFormatter(logging.Formatter('%(name)s:%(levelname)s:%(message)s'))
+    capture_handler.addFilter(lambda record: record.thread == thread_id)
+
+    def other_threads(record: logging.LogRecord) -> bool:
+        return record.thread != thread_id and record.levelno >= level
+
+    handlers = list(root_logger.handlers)
+    for handler in handlers:
+        handler.addFilter(other_threads)
+    root_logger.addHandler(capture_handler)
+    root_logger.setLevel(logging.DEBUG)
+
+    try:
+        yield
+    finally:
+        root_logger.setLevel(level)
+        root_logger.removeHandler(capture_handler)
+        for handler in handlers:
+            handler.removeFilter(other_threads)
+
+
+def _commit(project_path: str, message: str) -> str:
+    if pygit2 is not None:
+        return _commit_in_process(project_path, message)
+
+    _git(project_path, 'add', '--all', check=True)
+
+    # The "nothing to commit" message is translated, force the untranslated one
+    completed_process = _git(project_path, 'commit', '--quiet', '--message', message, capture_output=True, env={**os.environ, 'LC_ALL': 'C'})
+    if completed_process.returncode != 0 and b'nothing to commit' in completed_process.stdout:
+        return 'N/A'
+    completed_process.check_returncode()
+
+    return _get_commit_id(project_path)
+
+
+def _commit_in_process(project_path: str, message: str) -> str:
+    repository = _repositories.get(project_path)
+    if repository is None:
+        repository = _repositories[project_path] = pygit2.Repository(project_path)
+
+    index = repository.index
+    index.add_all()
+    index.write()
+
+    tree_id = index.write_tree()
+
+    if repository.head_is_unborn:
+        parents = []
+    elif repository.head.peel(pygit2.Commit).tree_id == tree_id:
+        return 'N/A'
+    else:
+        parents = [repository.head.target]
+
+    signature = repository.default_signature
+    commit_id = repository.create_commit('HEAD', signature, signature, message, tree_id, parents)
+    return str(commit_id)[:7]
+
+
+def _copy_template(template_path: str, project_path: str) -> None:
+    template_name = os.path.basename(template_path)
+    project_name = os.path.basename(project_path)
+
+    # Poetry would lay out dotted names as nested packages, which a rename can't reproduce
+    if '.' in project_name:
+        raise ValueError(f'{project_name!r} can\'t be created from a template, use new() without one')
+
+    # The same normalization Poetry applies to the distribution and package names
+    distribution_name = re.sub(r'[-_]+', '-', project_name).lower()
+    package_name = distribution_name.replace('-', '_')
+
+    shutil.copytree(template_path, project_path)
+
+    # Bottom-up, so directories are renamed after their contents were visited
+    for directory, dirnames, filenames in os.walk(project_path, topdown=False):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+
+            with open(path) as f:
+                content = f.read()
 
-logger = logging.getLogger(__name__)
+            if template_name in content:
+                content = content.replace(f'name = "{template_name}"', f'name = "{distribution_name}"')
+                with open(path, 'w') as f:
+                    f.write(content.replace(template_name, package_name))
+
+        for dirname in dirnames:
+            if dirname == template_name:
+                os.rename(os.path.join(directory, dirname), os.path.join(directory, package_name))
+
+
+def _create_template(root: str) -> str:
+    template_path = f'{root}/{_TEMPLATE_NAME}'
+    command = [*_NEW_COMMAND, template_path]
+    _execute(template_path, command, ' '.join(command))
+    return template_path
+
+
+def _execute(project_path: str, command: list[str], joined_command: str, cwd: str | None = None) -> None:
+    if cwd:
+        # Poetry's own option, instead of changing the working directory, which in a subprocess would rule out posix_spawn
+        command = [command[0], '--directory', cwd, *command[1:]]
+
+    if Application is None:
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            completed_process = subprocess.run([POETRY, *command[1:]], stdout=stdout, stderr=stderr, close_fds=False)
+            _log_output(project_path, joined_command, stdout, stderr)
+
+        completed_process.check_returncode()
+        return
+
+    output = BufferedOutput()
+    error_output = BufferedOutput()
+    log_stream = io.StringIO()
+
+    with _poetry_lock, _capture_logging(log_stream):
+        application = Application()
+        application.auto_exits(False)
+        returncode = application.run(ArgvInput(command), output, error_output)
+
+    stderr = error_output.fetch()
+    if stderr and not stderr.endswith('\n'):
+        stderr += '\n'
+    stderr += log_stream.getvalue()
+
+    completed_process = subprocess.CompletedProcess(command, returncode, output.fetch().encode(), stderr.encode())
+    _log_streams(project_path, joined_command, completed_process)
+    completed_process.check_returncode()
 
 
 def _get_commit_id(project_path: str) -> str:
-    completed_process = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_path, capture_output=True, check=True)
-    commit_id = completed_process.stdout.decode().rstrip()
+    with open(f'{project_path}/.git/HEAD') as f:
+        head = f.read().rstrip()
+
+    if head.startswith('ref: '):
+        try:
+            with open(f'{project_path}/.git/{head.removeprefix("ref: ")}') as f:
+                head = f.read().rstrip()
+        except FileNotFoundError:
+            # Packed ref, let git resolve it
+            head = _git(project_path, 'rev-parse', 'HEAD', capture_output=True, check=True).stdout.decode().rstrip()
+
+    commit_id = head[:7]
     return commit_id
 
 
-def _log_streams(project_path: str, completed_process: subprocess.CompletedProcess) -> None:
-    joined_command = ' '.join(completed_process.args)
+def _git(project_path: str, *args: str, **kwargs) -> subprocess.CompletedProcess:
+    # An absolute executable and no cwd or close_fds let subprocess posix_spawn git instead of fork + exec
+    return subprocess.run([GIT, '-C', project_path, *args], close_fds=False, **kwargs)
+
+
+def _log_output(project_path: str, joined_command: str, stdout: BinaryIO, stderr: BinaryIO) -> None:
+    if _log_handler is None:
+        return
+
+    # Let the listener write the records logged so far, so they come before this output
+    _log_queue.join()
+
+    # Under the handler's lock, so the output of concurrent commands and their records don't interleave
+    with _log_handler.lock:
+        _log_handler.flush()
+        with open(_log_handler.stream.fileno(), 'ab', closefd=False) as log_file:
+            # Same shape as _log_streams: a record per non-empty stream, followed by its content
+            for stream, output in ('stdout', stdout), ('stderr', stderr):
+                size = output.seek(0, os.SEEK_END)
+                if not size:
+                    continue
+
+                output.seek(size - 1)
+                ends_with_newline = output.read(1) == b'\n'
+                output.seek(0)
+
+                record = logger.makeRecord(logger.name, logging.INFO, __file__, 0, '%s, %s, %s:', (project_path, joined_command, stream), None)
+                log_file.write(f'{_log_handler.format(record)}\n'.encode())
+                shutil.copyfileobj(output, log_file)
+                if not ends_with_newline:
+                    log_file.write(b'\n')
+
+
+def _log_streams(project_path: str, joined_command: str, completed_process: subprocess.CompletedProcess) -> None:
+    if not (completed_process.stdout or completed_process.stderr):
+        return
 
     for stream in 'stdout', 'stderr':
         stream_content = getattr(completed_process, stream)
         if stream_content:
-            decoded_stream_content = stream_content.decode().rstrip()
+            decoded_stream_content = stream_content.decode('utf-8', 'replace').rstrip()
             logger.info('%s, %s, %s:\n%s', project_path, joined_command, stream, decoded_stream_content)
 
 
 def _run(project_path: str, command: list[str]) -> None:
-    completed_process = subprocess.run(command, cwd=project_path, capture_output=True, check=True)
-    _log_streams(project_path, completed_process)
-
     joined_command = ' '.join(command)
 
-    if subprocess.run(['git', 'diff', '--quiet'], cwd=project_path).returncode != 0:
-        subprocess.run(['git', 'add', '.'], cwd=project_path, check=True)
-        subprocess.run(['git', 'commit', '--quiet', '--message', joined_command], cwd=project_path, check=True)
-
-        commit_id = _get_commit_id(project_path)
-    else:
-        commit_id = 'N/A'
+    _execute(project_path, command, joined_command, cwd=project_path)
 
+    commit_id = _commit(project_path, joined_command)
     logger.info('%s, %s, %s', project_path, joined_command, commit_id)
 
 
 def _setup_logger(filename: str) -> None:
+    handler = logging.FileHandler(filename, mode='w')
+    handler.setFormatter(_Formatter())
+
+    # Logging calls only enqueue, the file is written from the listener's thread
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    global _log_handler, _log_queue
+    _log_handler = handler
+    _log_queue = log_queue
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Leave the prefix to _Formatter, instead of letting basicConfig install its own
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+
     logging.basicConfig(
-        datefmt='%Y-%m-%d %H:%M:%S',
-        filemode='w',
-        filename=filename,
-        format='%(name)s:%(levelname)s:%(asctime)s:%(message)s',
+        handlers=[queue_handler],
         level='INFO',
     )
 
 
 def add_dependency(project_path: str, dependency: str, source_name: str | None = None) -> None:
     if source_name:
-        source_args = ['--source', source_name]
+        source_args = ('--source', source_name)
     else:
-        source_args = []
+        source_args = ()
 
-    _run(project_path, ['poetry', 'add', *COMMON_FLAGS, '--lock', *source_args, dependency])
+    _run(project_path, [*_ADD_COMMAND, *source_args, dependency])
 
 
 def add_source(project_path: str, source_name: str, source_url: str) -> None:
-    _run(project_path, ['poetry', 'source', 'add', *COMMON_FLAGS, source_name, source_url])
+    # Same table `poetry source add` writes, without paying for a Poetry run
+    with open(f'{project_path}/pyproject.toml', 'a') as f:
+        f.write(f'\n[[tool.poetry.source]]\nname = "{source_name}"\nurl = "{source_url}"\npriority = "primary"\n')
+
+    message = f'add source {source_name} {source_url}'
+    commit_id = _commit(project_path, message)
+    logger.info('%s, %s, %s', project_path, message, commit_id)
 
 
 def build(project_path: str) -> None:
-    _run(project_path, ['poetry', 'build', *COMMON_FLAGS, '--format', 'wheel'])
+    _run(project_path, list(_BUILD_COMMAND))
 
 
 def bump_version(project_path: str, version: str = 'patch') -> None:
-    _run(project_path, ['poetry', 'version', *COMMON_FLAGS, version])
+    _run(project_path, [*_VERSION_COMMAND, version])
 
 
 def lock(project_path: str) -> None:
-    _run(project_path, ['poetry', 'lock', *COMMON_FLAGS])
-
+    _run(project_path, list(_LOCK_COMMAND))
 
-def new(project_path: str) -> None:
-    command = ['poetry', 'new', *COMMON_FLAGS, project_path]
 
-    completed_process = subprocess.run(command, capture_output=True, check=True)
-    _log_streams(project_path, completed_process)
-
-    joined_command = ' '.join(command)
-
-    subprocess.run(['git', 'init', '--quiet', '--initial-branch', 'main'], cwd=project_path, check=True)
-    subprocess.run(['git', 'config', 'user.email', 'you@example.com'], cwd=project_path, check=True)
-    subprocess.run(['git', 'config', 'user.name', 'Your Name'], cwd=project_path, check=True)
+def new(project_path: str, template_path: str | None = None) -> None:
+    if template_path:
+        _copy_template(template_path, project_path)
+        joined_command = f'copy {template_path} {project_path}'
+    else:
+        command = [*_NEW_COMMAND, project_path]
+        joined_command = ' '.join(command)
+        _execute(project_path, command, joined_command)
+
+    if pygit2 is not None:
+        repository = _repositories[project_path] = pygit2.init_repository(project_path, initial_head='main')
+        repository.config['user.email'] = 'you@example.com'
+        repository.config['user.name'] = 'Your Name'
+    else:
+        _git(project_path, 'init', '--quiet', '--initial-branch', 'main', check=True)
+        _git(project_path, 'config', 'user.email', 'you@example.com', check=True)
+        _git(project_path, 'config', 'user.name', 'Your Name', check=True)
 
     with open(f'{project_path}/.gitignore', 'w') as f:
         f.write('dist')
 
-    subprocess.run(['git', 'add', '.'], cwd=project_path, check=True)
-    subprocess.run(['git', 'commit', '--quiet', '--message', joined_command], cwd=project_path, check=True)
-
-    commit_id = _get_commit_id(project_path)
+    commit_id = _commit(project_path, joined_command)
     logger.info('%s, %s, %s', project_path, joined_command, commit_id)
 
 
 def publish(project_path: str, repository_name: str) -> None:
-    _run(project_path, ['poetry', 'publish', *COMMON_FLAGS, '--repository', repository_name])
+    _run(project_path, [*_PUBLISH_COMMAND, repository_name])
 
 
 def remove_environment(project_path: str) -> None:
-    _run(project_path, ['poetry', 'env', 'remove', *COMMON_FLAGS, '--all'])
+    _run(project_path, list(_ENV_REMOVE_COMMAND))
 
 
 def remove_lock(project_path: str) -> None:
@@ -120,16 +386,20 @@ def remove_lock(project_path: str) -> None:
 
 
 def update_all_dependencies(project_path: str) -> None:
-    _run(project_path, ['poetry', 'update', *COMMON_FLAGS, '--lock'])
+    _run(project_path, list(_UPDATE_COMMAND))
 
 
 def update_dependency(project_path: str, dependency: str) -> None:
-    _run(project_path, ['poetry', 'update', *COMMON_FLAGS, '--lock', dependency])
+    _run(project_path, [*_UPDATE_COMMAND, dependency])
 
 
 def main() -> None:
-    now = datetime.datetime.now()
-    log_filename = f'{now:%Y%m%d%H%M%S}.log'
+    if pygit2 is None and GIT is None:
+        raise FileNotFoundError('git not found in PATH')
+    if Application is None and POETRY is None:
+        raise FileNotFoundError('poetry not found in PATH, and Poetry is not importable')
+
+    log_filename = time.strftime('%Y%m%d%H%M%S.log')
 
     _setup_logger(log_filename)
     print(log_filename)
@@ -137,6 +407,9 @@ def main() -> None:
     temp_root = tempfile.mkdtemp()
     print(temp_root)
 
+    # Projects are only locked, built and published, never installed
+    os.environ['POETRY_VIRTUALENVS_CREATE'] = 'false'
+
     # lorito is a direct dependency of gatito
     # gatito is a direct dependency of perrito
 
@@ -149,8 +422,10 @@ def main() -> None:
 
     # ------------------------------------------------------------------
 
+    template_path = _create_template(temp_root)
+
     for project_path in LORITO_PATH, GATITO_PATH, PERRITO_PATH:
-        new(project_path)
+        new(project_path, template_path)
         add_source(project_path, LOCAL_SOURCE_NAME, LOCAL_SOURCE_URL)
 
     add_dependency(LORITO_PATH, 'requests')